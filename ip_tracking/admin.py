@@ -1,10 +1,44 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from .models import RequestLog, BlockedIP, GeolocationCache
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that takes the size of an unfiltered table from PostgreSQL's
+    planner statistics instead of running COUNT(*) over every row
+    """
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                    [queryset.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            # reltuples is -1 (or 0) until the table has been analyzed
+            if row and row[0] > 0:
+                return row[0]
+        return super().count
+
+class RequestLogChangeList(ChangeList):
+    """Only load the columns the request log list actually displays"""
+    def get_queryset(self, request, *args, **kwargs):
+        return super().get_queryset(request, *args, **kwargs).only(
+            'ip_address', 'country', 'city', 'path', 'timestamp'
+        )
+
 @admin.register(RequestLog)
 class RequestLogAdmin(admin.ModelAdmin):
     list_display = ('ip_address', 'country', 'city', 'path', 'timestamp')
     list_filter = ('country', 'city', 'timestamp')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     search_fields = ('ip_address', 'path', 'country', 'city')
     readonly_fields = ('ip_address', 'timestamp', 'path', 'country', 'city', 
                       'region', 'latitude', 'longitude', 'timezone', 'isp')
@@ -17,16 +51,19 @@ class RequestLogAdmin(admin.ModelAdmin):
                       'latitude', 'longitude', 'timezone', 'isp')
         }),
     )
+    
+    def get_changelist(self, request, **kwargs):
+        return RequestLogChangeList
 
 @admin.register(BlockedIP)
 class BlockedIPAdmin(admin.ModelAdmin):
-    list_display = ('ip_address', 'created_at', 'reason')
+    list_display = ('ip_address', 'cidr', 'created_at', 'reason')
     list_filter = ('created_at',)
-    search_fields = ('ip_address', 'reason')
+    search_fields = ('ip_address', 'cidr', 'reason')
 
 @admin.register(GeolocationCache)
 class GeolocationCacheAdmin(admin.ModelAdmin):
-    list_display = ('ip_address', 'country', 'city', 'updated_at')
+    list_display = ('ip_address', 'country', 'city', 'updated_at', 'expires_at')
     list_filter = ('country', 'updated_at')
     search_fields = ('ip_address', 'country', 'city')
-    readonly_fields = ('ip_address', 'created_at', 'updated_at')
+    readonly_fields = ('ip_address', 'created_at', 'updated_at', 'expires_at')
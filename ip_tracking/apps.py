@@ -0,0 +1,25 @@
+from django.apps import AppConfig
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+
+class IpTrackingConfig(AppConfig):
+    name = 'ip_tracking'
+    verbose_name = 'IP Tracking'
+
+    def ready(self):
+        from .middleware import _mark_blocked_stale
+        from .models import BlockedIP
+
+        def mark_blocked_ips_stale(sender, using=None, **kwargs):
+            """
+            Have the middleware reload its blocklist once a BlockedIP change
+            commits (a bulk delete sends one signal per row, but the next
+            request reloads only once, and a rollback changes nothing)
+            """
+            transaction.on_commit(_mark_blocked_stale, using=using)
+
+        post_save.connect(mark_blocked_ips_stale, sender=BlockedIP, weak=False,
+                          dispatch_uid='ip_tracking_reload_blocked_ips_save')
+        post_delete.connect(mark_blocked_ips_stale, sender=BlockedIP, weak=False,
+                            dispatch_uid='ip_tracking_reload_blocked_ips_delete')
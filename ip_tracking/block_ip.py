@@ -1,17 +1,17 @@
 from django.core.management.base import BaseCommand, CommandError
-from django.db import IntegrityError
+from django.db.models import Q
 from ip_tracking.models import BlockedIP
 import ipaddress
 
 class Command(BaseCommand):
-    help = 'Block one or more IP addresses by adding them to the BlockedIP model'
+    help = 'Block one or more IP addresses or CIDR ranges by adding them to the BlockedIP model'
     
     def add_arguments(self, parser):
         parser.add_argument(
             'ip_addresses',
             nargs='+',
             type=str,
-            help='One or more IP addresses to block'
+            help='One or more IP addresses or CIDR ranges (e.g. 203.0.113.0/24) to block'
         )
         parser.add_argument(
             '--reason',
@@ -26,41 +26,58 @@ class Command(BaseCommand):
         success_count = 0
         error_count = 0
         
+        # Validate everything up front, normalising so duplicates and
+        # existing rows compare equal to what the database stores.
+        # Dicts keep the entries unique and in command-line order.
+        addresses = {}
+        networks = {}
         for ip in ip_addresses:
             try:
-                # Validate IP address format
-                ipaddress.ip_address(ip)
-                
-                # Create blocked IP entry
-                blocked_ip, created = BlockedIP.objects.get_or_create(
-                    ip_address=ip,
-                    defaults={'reason': reason}
-                )
-                
-                if created:
-                    self.stdout.write(
-                        self.style.SUCCESS(f'Successfully blocked IP: {ip}')
-                    )
-                    success_count += 1
+                if '/' in ip:
+                    networks[str(ipaddress.ip_network(ip, strict=False))] = None
                 else:
-                    self.stdout.write(
-                        self.style.WARNING(f'IP already blocked: {ip}')
-                    )
-                    
+                    addresses[str(ipaddress.ip_address(ip))] = None
             except ValueError:
                 self.stdout.write(
                     self.style.ERROR(f'Invalid IP address format: {ip}')
                 )
                 error_count += 1
-            except IntegrityError:
-                self.stdout.write(
-                    self.style.WARNING(f'IP already blocked: {ip}')
-                )
+        
+        if addresses or networks:
+            try:
+                existing = set()
+                for ip_address, cidr in BlockedIP.objects.filter(
+                    Q(ip_address__in=list(addresses)) | Q(cidr__in=list(networks))
+                ).values_list('ip_address', 'cidr'):
+                    existing.add(ip_address or cidr)
+                
+                new_entries = [
+                    BlockedIP(ip_address=ip, reason=reason)
+                    for ip in addresses if ip not in existing
+                ] + [
+                    BlockedIP(cidr=cidr, reason=reason)
+                    for cidr in networks if cidr not in existing
+                ]
+                
+                # Create all blocked IP entries in one statement; rows added
+                # concurrently since the lookup above are skipped, not errors
+                BlockedIP.objects.bulk_create(new_entries, ignore_conflicts=True, batch_size=1000)
             except Exception as e:
                 self.stdout.write(
-                    self.style.ERROR(f'Error blocking IP {ip}: {str(e)}')
+                    self.style.ERROR(f'Error blocking IPs: {str(e)}')
                 )
-                error_count += 1
+                error_count += len(addresses) + len(networks)
+            else:
+                for ip in [*addresses, *networks]:
+                    if ip in existing:
+                        self.stdout.write(
+                            self.style.WARNING(f'IP already blocked: {ip}')
+                        )
+                    else:
+                        self.stdout.write(
+                            self.style.SUCCESS(f'Successfully blocked IP: {ip}')
+                        )
+                        success_count += 1
         
         # Summary
         self.stdout.write(
@@ -0,0 +1,162 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+import logging
+import requests
+from types import MappingProxyType
+from requests.adapters import HTTPAdapter
+from .models import GeolocationCache
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+logger = logging.getLogger(__name__)
+
+GEOLOCATION_CACHE_TIMEOUT = 86400  # 24 hours
+
+# Shared HTTP session so provider lookups reuse pooled keep-alive connections
+_HTTP = requests.Session()
+_HTTP.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
+_HTTP.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
+
+GEOLOCATION_FIELDS = (
+    'country', 'country_name', 'city', 'region',
+    'latitude', 'longitude', 'timezone', 'isp',
+)
+
+# Shared read-only result for addresses without geolocation data, so the
+# common private/unknown path doesn't build a new dict per request.
+# Copy it with dict() before caching; mapping proxies can't be pickled.
+EMPTY_GEOLOCATION = MappingProxyType(dict.fromkeys(GEOLOCATION_FIELDS))
+
+# Memory-mapped GeoLite2 reader; None until first use, False if unavailable
+_GEOIP_READER = None
+
+
+def get_geoip_reader():
+    """
+    Open the GeoLite2 City database named by settings.IP_TRACKING_GEOIP_DATABASE.
+    Returns None if maxminddb isn't installed or no database is configured.
+    """
+    global _GEOIP_READER
+    if _GEOIP_READER is None:
+        path = getattr(settings, 'IP_TRACKING_GEOIP_DATABASE', None)
+        _GEOIP_READER = False
+        if maxminddb is not None and path:
+            try:
+                _GEOIP_READER = maxminddb.open_database(path, mode=maxminddb.MODE_AUTO)
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not open GeoIP database {path}: {str(e)}")
+    return _GEOIP_READER or None
+
+
+def lookup_local_geolocation(ip_address):
+    """
+    Look an IP address up in the local GeoLite2 database.
+    Returns None if the database is unavailable or has no record for it.
+    """
+    reader = get_geoip_reader()
+    if reader is None:
+        return None
+    try:
+        record = reader.get(ip_address)
+    except ValueError:
+        return None
+    if not record:
+        return None
+    
+    country = record.get('country', {})
+    location = record.get('location', {})
+    subdivisions = record.get('subdivisions') or [{}]
+    return {
+        'country': country.get('iso_code'),
+        'country_name': country.get('names', {}).get('en'),
+        'city': record.get('city', {}).get('names', {}).get('en'),
+        'region': subdivisions[0].get('names', {}).get('en'),
+        'latitude': location.get('latitude'),
+        'longitude': location.get('longitude'),
+        'timezone': location.get('time_zone'),
+        'isp': None  # Not part of the GeoLite2 City database
+    }
+
+
+def geolocation_cache_key(ip_address):
+    return f'ip_geolocation_{ip_address}'
+
+
+def geolocation_pending_key(ip_address):
+    return f'ip_geolocation_pending_{ip_address}'
+
+
+def fetch_geolocation_data(ip_address):
+    """
+    Fetch geolocation data from the local GeoLite2 database if configured,
+    otherwise from external APIs using multiple fallback providers
+    """
+    local_data = lookup_local_geolocation(ip_address)
+    if local_data:
+        return local_data
+
+    # Try ip-api.com first (free tier available)
+    try:
+        response = _HTTP.get(f'http://ip-api.com/json/{ip_address}?fields=status,message,country,countryCode,region,regionName,city,zip,lat,lon,timezone,isp,org,as,query', timeout=2)
+        if response.status_code == 200:
+            data = response.json()
+            if data.get('status') == 'success':
+                return {
+                    'country': data.get('countryCode'),
+                    'country_name': data.get('country'),
+                    'city': data.get('city'),
+                    'region': data.get('regionName'),
+                    'latitude': data.get('lat'),
+                    'longitude': data.get('lon'),
+                    'timezone': data.get('timezone'),
+                    'isp': data.get('isp')
+                }
+    except:
+        pass
+
+    # Fallback to country.is API :cite[9]
+    try:
+        response = _HTTP.get(f'https://api.country.is/{ip_address}', timeout=2)
+        if response.status_code == 200:
+            data = response.json()
+            return {
+                'country': data.get('country'),
+                'country_name': None,
+                'city': None,
+                'region': None,
+                'latitude': None,
+                'longitude': None,
+                'timezone': None,
+                'isp': None
+            }
+    except:
+        pass
+
+    # Final fallback: return empty data
+    return EMPTY_GEOLOCATION
+
+
+def store_geolocation_data(ip_address, geolocation_data):
+    """Save geolocation data to the Django cache and the database cache"""
+    geolocation_data = dict(geolocation_data)
+    cache.set(geolocation_cache_key(ip_address), geolocation_data,
+              timeout=GEOLOCATION_CACHE_TIMEOUT)
+    try:
+        # Single INSERT ... ON CONFLICT UPDATE instead of update_or_create's
+        # locked SELECT followed by a full-row save()
+        GeolocationCache.objects.bulk_create(
+            [GeolocationCache(
+                ip_address=ip_address,
+                expires_at=timezone.now() + GeolocationCache.TTL,
+                **geolocation_data
+            )],
+            update_conflicts=True,
+            unique_fields=['ip_address'],
+            update_fields=[*GEOLOCATION_FIELDS, 'updated_at', 'expires_at']
+        )
+    except:
+        pass
@@ -1,180 +1,410 @@
 from django.utils import timezone
 from django.http import HttpResponseForbidden
 from django.core.cache import cache
-import requests
-import json
+from django.db import close_old_connections, DataError, IntegrityError
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+import socket
+import struct
+import ipaddress
+import re
+from functools import lru_cache
+from cachetools import TTLCache
 from .models import RequestLog, BlockedIP, GeolocationCache
+from .geolocation import (
+    geolocation_cache_key, geolocation_pending_key,
+    lookup_local_geolocation, GEOLOCATION_CACHE_TIMEOUT, GEOLOCATION_FIELDS,
+    EMPTY_GEOLOCATION
+)
+from .tasks import fetch_and_update_geolocation
+
+logger = logging.getLogger(__name__)
+
+# How long a process may serve its in-memory blocklist before re-reading it.
+# Signals mark it stale in the process that made the change once it commits; this
+# bounds staleness for changes made elsewhere (other workers, Celery, shell).
+BLOCKED_IPS_REFRESH_SECONDS = 60
+
+# How long to wait before retrying a geolocation lookup that never completed
+GEOLOCATION_PENDING_TIMEOUT = 300
+
+# Non-routable networks as (network, netmask) integer pairs, so the
+# private-address check is a few integer ANDs instead of string parsing
+_PRIVATE_V4 = tuple(
+    (int(net.network_address), int(net.netmask))
+    for net in map(ipaddress.IPv4Network, (
+        '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8',
+        '169.254.0.0/16', '172.16.0.0/12', '192.168.0.0/16',
+    ))
+)
+_PRIVATE_V6 = tuple(
+    (int(net.network_address), int(net.netmask))
+    for net in map(ipaddress.IPv6Network, (
+        '::/127', 'fc00::/7', 'fe80::/10',
+    ))
+)
+
+# Paths that are mostly crawler/monitoring noise; their log entries skip geolocation
+_SKIP_GEO_PATHS = frozenset({'/robots.txt', '/favicon.ico', '/healthz', '/ping'})
+_STATIC_RE = re.compile(r'/(?:static|media)/')
+
+# Per-process geolocation cache checked before the shared Django cache
+_GEO_LOCAL = TTLCache(maxsize=50_000, ttl=GEOLOCATION_CACHE_TIMEOUT)
+_GEO_LOCAL_LOCK = threading.Lock()
+
+
+def _ip_to_int(ip_address):
+    """
+    Pack an IP address string into an integer.
+    Returns a (version, int) tuple, or None if it is not a valid address.
+    """
+    try:
+        return 4, struct.unpack('!I', socket.inet_aton(ip_address))[0]
+    except (OSError, TypeError):
+        pass
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_address), 'big')
+    except (OSError, TypeError):
+        return None
+
+
+class BlockedNetworks:
+    """
+    Prefix-match membership test over blocked addresses and networks.
+    Networks are grouped by prefix length into sets of masked integers,
+    so a lookup costs one set probe per distinct prefix length in use
+    (single addresses are just /32 or /128 networks).
+    """
+
+    def __init__(self, networks=()):
+        tables = {4: {}, 6: {}}
+        for network in networks:
+            tables[network.version].setdefault(network.prefixlen, set()).add(
+                int(network.network_address)
+            )
+        self._tables = {
+            version: tuple(
+                (self._netmask(version, prefixlen), frozenset(addresses))
+                for prefixlen, addresses in sorted(by_prefix.items(), reverse=True)
+            )
+            for version, by_prefix in tables.items()
+        }
+
+    @staticmethod
+    def _netmask(version, prefixlen):
+        bits = 32 if version == 4 else 128
+        return ((1 << bits) - 1) ^ ((1 << (bits - prefixlen)) - 1)
+
+    def __contains__(self, ip_address):
+        packed = _ip_to_int(ip_address)
+        if packed is None:
+            return False
+        version, ip_int = packed
+        return any((ip_int & mask) in addresses for mask, addresses in self._tables[version])
+
+
+def parse_client_ip(request):
+    """
+    Get the client's IP address from the request object.
+    Handles various proxy scenarios.
+    """
+    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    if x_forwarded_for:
+        # X-Forwarded-For header can contain multiple IPs, the first one is the original client.
+        # partition() takes it without building a list of every hop.
+        ip = x_forwarded_for.partition(',')[0].strip()
+        try:
+            ipaddress.ip_address(ip)
+            return ip
+        except ValueError:
+            # Malformed header; fall back to the connecting address
+            pass
+    return request.META.get('REMOTE_ADDR')
+
+
+@lru_cache(maxsize=10_000)
+def _blocked_response_body(ip_address):
+    """Encoded 403 body, cached so repeat requests from a blocked IP skip formatting"""
+    return f"Access denied. Your IP address ({ip_address}) has been blocked.".encode()
+
+
+_BLOCKED_IPS = BlockedNetworks()
+_BLOCKED_IPS_LOADED_AT = None
+
+
+def _load_blocked():
+    """Reload the in-memory set of blocked IP addresses and networks from the database"""
+    global _BLOCKED_IPS, _BLOCKED_IPS_LOADED_AT
+    networks = []
+    for ip_address, cidr in BlockedIP.objects.values_list('ip_address', 'cidr'):
+        try:
+            networks.append(ipaddress.ip_network(ip_address or cidr, strict=False))
+        except (ValueError, TypeError):
+            logger.warning(f"Ignoring invalid BlockedIP entry: {ip_address or cidr}")
+    _BLOCKED_IPS = BlockedNetworks(networks)
+    _BLOCKED_IPS_LOADED_AT = time.monotonic()
+    return _BLOCKED_IPS
+
+
+def _mark_blocked_stale():
+    """Make the next blocklist check reload from the database"""
+    global _BLOCKED_IPS_LOADED_AT
+    _BLOCKED_IPS_LOADED_AT = None
+
+
+# Queued to tell the flusher thread to write what it holds and exit
+_STOP = object()
+
+
+class RequestLogWriter:
+    """
+    Buffers RequestLog entries in memory and writes them in batches
+    from a background thread, keeping the INSERT off the request path.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=2.0, maxsize=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.maxsize = maxsize
+        self._atexit_registered = False
+        self._reset()
+        # Threads don't survive fork(); a preforking server (gunicorn --preload,
+        # uWSGI) would otherwise leave each worker with a dead flusher and a
+        # copy of the master's queue
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Start over with an empty queue and no flusher thread"""
+        self._queue = queue.Queue(maxsize=self.maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the flusher thread (once per process)"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='request-log-writer', daemon=True
+                )
+                self._thread.start()
+                if not self._atexit_registered:
+                    atexit.register(self.stop)
+                    self._atexit_registered = True
+
+    def put(self, entry):
+        """Queue an unsaved RequestLog instance for writing"""
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            # The writer is falling behind; write inline rather than drop the entry
+            self._write([entry])
+
+    def flush(self):
+        """Write everything currently queued"""
+        batch = []
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is not _STOP:
+                batch.append(entry)
+        if batch:
+            self._write(batch)
+
+    def stop(self, timeout=5.0):
+        """
+        Stop the flusher thread at exit. The thread writes the batch it is
+        still collecting before it returns; that batch is no longer in the
+        queue, so flush() alone would lose it.
+        """
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+                thread.join(timeout)
+            except queue.Full:
+                pass
+        # Whatever the thread didn't get to
+        self.flush()
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is _STOP:
+                return
+            batch = [entry]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    self._write_from_thread(batch)
+                    return
+                batch.append(entry)
+            self._write_from_thread(batch)
+
+    def _write_from_thread(self, batch):
+        # The thread keeps its own connection between batches; drop it if it
+        # has gone stale. Only done here: on a request thread this could close
+        # the connection in the middle of the request's transaction
+        close_old_connections()
+        self._write(batch)
+
+    def _write(self, batch):
+        try:
+            RequestLog.objects.bulk_create(batch, batch_size=self.batch_size)
+        except (DataError, IntegrityError) as e:
+            if len(batch) == 1:
+                logger.error(f"Failed to write request log entry for {batch[0].ip_address}: {str(e)}")
+                return
+            # bulk_create is atomic, so nothing was written; retry row by row
+            # so a single bad entry doesn't discard the rest of the batch
+            logger.warning(f"Batch write of {len(batch)} request log entries failed, retrying individually: {str(e)}")
+            for entry in batch:
+                self._write([entry])
+        except Exception as e:
+            # Not caused by the data (e.g. the database is down), so retrying
+            # each row would only repeat the same failure
+            logger.error(f"Failed to write {len(batch)} request log entries: {str(e)}")
+
+
+request_log_writer = RequestLogWriter()
+
 
 class IPLoggingMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
+        # The blocklist is loaded on the first request (see is_ip_blocked), not
+        # here: under a preforking server this runs in the master, and forked
+        # workers would share the connection opened for the query
     
     def __call__(self, request):
-        # Get the client IP address
+        # Get the client IP address, stashed for views (see views.get_client_ip)
         ip_address = self.get_client_ip(request)
+        request.client_ip = ip_address
         
         # Check if IP is blocked
         if self.is_ip_blocked(ip_address):
             return HttpResponseForbidden(
-                f"Access denied. Your IP address ({ip_address}) has been blocked."
+                _blocked_response_body(ip_address), content_type='text/plain'
             )
         
         # Get geolocation data (with caching)
-        geolocation_data = self.get_geolocation_data(ip_address)
+        if request.path in _SKIP_GEO_PATHS or _STATIC_RE.match(request.path):
+            geolocation_data = EMPTY_GEOLOCATION
+        else:
+            geolocation_data = self.get_geolocation_data(ip_address)
         
-        # Create and save the log entry
-        RequestLog.objects.create(
+        # Queue the log entry; it is written in the next batch
+        request_log_writer.put(RequestLog(
             ip_address=ip_address,
+            timestamp=timezone.now(),
             path=request.path,
             **geolocation_data
-        )
+        ))
         
         response = self.get_response(request)
         return response
     
     def get_client_ip(self, request):
-        """
-        Get the client's IP address from the request object.
-        Handles various proxy scenarios.
-        """
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            # X-Forwarded-For header can contain multiple IPs, the first one is the original client
-            ip = x_forwarded_for.split(',')[0].strip()
-        else:
-            ip = request.META.get('REMOTE_ADDR')
-        return ip
+        """Get the client's IP address from the request object"""
+        return parse_client_ip(request)
     
     def is_ip_blocked(self, ip_address):
         """Check if the IP address is in the blocked list"""
-        return BlockedIP.objects.filter(ip_address=ip_address).exists()
+        if (_BLOCKED_IPS_LOADED_AT is None or
+                time.monotonic() - _BLOCKED_IPS_LOADED_AT > BLOCKED_IPS_REFRESH_SECONDS):
+            _load_blocked()
+        return ip_address in _BLOCKED_IPS
     
     def get_geolocation_data(self, ip_address):
         """
-        Get geolocation data for an IP address with caching
-        Uses multiple fallback methods for geolocation
+        Get geolocation data for an IP address from the caches.
+        On a miss the lookup is scheduled in the background and empty
+        data is returned; the log entry is backfilled once it completes.
         """
         # Check if IP is private/local
         if self.is_private_ip(ip_address):
-            return {
-                'country': None,
-                'country_name': None,
-                'city': None,
-                'region': None,
-                'latitude': None,
-                'longitude': None,
-                'timezone': None,
-                'isp': None
-            }
+            return EMPTY_GEOLOCATION
+        
+        # Try the in-process cache first, then the shared cache
+        with _GEO_LOCAL_LOCK:
+            local_data = _GEO_LOCAL.get(ip_address)
+        if local_data:
+            return local_data
         
-        # Try to get from cache first
-        cache_key = f'ip_geolocation_{ip_address}'
+        # A local GeoLite2 database answers in microseconds, no caching needed
+        local_data = lookup_local_geolocation(ip_address)
+        if local_data:
+            return local_data
+        
+        cache_key = geolocation_cache_key(ip_address)
         cached_data = cache.get(cache_key)
         
         if cached_data:
+            with _GEO_LOCAL_LOCK:
+                _GEO_LOCAL[ip_address] = cached_data
             return cached_data
         
         # Try database cache
         try:
-            db_cache = GeolocationCache.objects.filter(ip_address=ip_address).first()
-            if db_cache and not db_cache.is_expired():
-                data = {
-                    'country': db_cache.country,
-                    'country_name': db_cache.country_name,
-                    'city': db_cache.city,
-                    'region': db_cache.region,
-                    'latitude': db_cache.latitude,
-                    'longitude': db_cache.longitude,
-                    'timezone': db_cache.timezone,
-                    'isp': db_cache.isp
-                }
+            data = GeolocationCache.objects.filter(
+                ip_address=ip_address,
+                expires_at__gt=timezone.now()
+            ).values(*GEOLOCATION_FIELDS).first()
+            if data:
                 # Store in Django cache for faster access
-                cache.set(cache_key, data, timeout=86400)  # 24 hours
+                cache.set(cache_key, data, timeout=GEOLOCATION_CACHE_TIMEOUT)
+                with _GEO_LOCAL_LOCK:
+                    _GEO_LOCAL[ip_address] = data
                 return data
         except:
             # Database might not be ready yet
             pass
         
-        # Get fresh geolocation data
-        geolocation_data = self.fetch_geolocation_data(ip_address)
+        # Fetch fresh geolocation data in the background, once per IP at a time
+        self.schedule_geolocation_lookup(ip_address)
         
-        # Update cache
-        cache.set(cache_key, geolocation_data, timeout=86400)  # 24 hours
-        
-        # Update database cache
+        return EMPTY_GEOLOCATION
+    
+    def schedule_geolocation_lookup(self, ip_address):
+        """Queue a background geolocation lookup unless one is already pending"""
+        if not cache.add(geolocation_pending_key(ip_address), True,
+                         timeout=GEOLOCATION_PENDING_TIMEOUT):
+            return
         try:
-            GeolocationCache.objects.update_or_create(
-                ip_address=ip_address,
-                defaults=geolocation_data
+            # Wait for the log writer to flush so the backfill sees this request's entry
+            # Only entries logged from now on are backfilled
+            fetch_and_update_geolocation.apply_async(
+                (ip_address, timezone.now().isoformat()),
+                countdown=request_log_writer.flush_interval
             )
-        except:
-            pass
-        
-        return geolocation_data
+        except Exception as e:
+            cache.delete(geolocation_pending_key(ip_address))
+            logger.error(f"Could not schedule geolocation lookup for {ip_address}: {str(e)}")
     
     def is_private_ip(self, ip_address):
         """Check if IP address is private/reserved"""
-        if ip_address.startswith('10.') or \
-           ip_address.startswith('172.16.') or \
-           ip_address.startswith('192.168.') or \
-           ip_address == '127.0.0.1' or \
-           ip_address == '::1':
+        packed = _ip_to_int(ip_address)
+        if packed is None:
+            # Not a usable address, so there is nothing to geolocate
             return True
-        return False
-    
-    def fetch_geolocation_data(self, ip_address):
-        """
-        Fetch geolocation data from external API
-        Uses multiple fallback providers
-        """
-        # Try ip-api.com first (free tier available)
-        try:
-            response = requests.get(f'http://ip-api.com/json/{ip_address}?fields=status,message,country,countryCode,region,regionName,city,zip,lat,lon,timezone,isp,org,as,query', timeout=2)
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('status') == 'success':
-                    return {
-                        'country': data.get('countryCode'),
-                        'country_name': data.get('country'),
-                        'city': data.get('city'),
-                        'region': data.get('regionName'),
-                        'latitude': data.get('lat'),
-                        'longitude': data.get('lon'),
-                        'timezone': data.get('timezone'),
-                        'isp': data.get('isp')
-                    }
-        except:
-            pass
-        
-        # Fallback to country.is API :cite[9]
-        try:
-            response = requests.get(f'https://api.country.is/{ip_address}', timeout=2)
-            if response.status_code == 200:
-                data = response.json()
-                return {
-                    'country': data.get('country'),
-                    'country_name': None,
-                    'city': None,
-                    'region': None,
-                    'latitude': None,
-                    'longitude': None,
-                    'timezone': None,
-                    'isp': None
-                }
-        except:
-            pass
-        
-        # Final fallback: return empty data
-        return {
-            'country': None,
-            'country_name': None,
-            'city': None,
-            'region': None,
-            'latitude': None,
-            'longitude': None,
-            'timezone': None,
-            'isp': None
-        }
+        version, ip_int = packed
+        networks = _PRIVATE_V4 if version == 4 else _PRIVATE_V6
+        return any(ip_int & mask == net for net, mask in networks)
 
 
 # Alternative implementation using django-ip-geolocation middleware
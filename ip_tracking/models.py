@@ -2,10 +2,12 @@ from django.db import models
 from django.core.exceptions import ValidationError
 import ipaddress
 from django.utils import timezone
+from datetime import timedelta
 
 class RequestLog(models.Model):
     ip_address = models.GenericIPAddressField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the request is handled, not when the batched INSERT runs
+    timestamp = models.DateTimeField(default=timezone.now)
     path = models.CharField(max_length=255)
     country = models.CharField(max_length=2, blank=True, null=True, help_text="2-letter country code")
     country_name = models.CharField(max_length=100, blank=True, null=True, help_text="Full country name")
@@ -21,10 +23,13 @@ class RequestLog(models.Model):
         verbose_name = 'Request Log'
         verbose_name_plural = 'Request Logs'
         indexes = [
-            models.Index(fields=['ip_address']),
-            models.Index(fields=['country']),
+            models.Index(fields=['ip_address', '-timestamp'], name='rl_ip_ts_idx'),
+            models.Index(fields=['country', '-timestamp'], name='rl_country_ts_idx'),
+            models.Index(fields=['path', '-timestamp'], name='rl_path_ts_idx'),
+            # Covers the anomaly-detection aggregate (time range, grouped by IP,
+            # filtered by path) so it can be answered from the index alone
+            models.Index(fields=['timestamp', 'ip_address', 'path'], name='reqlog_ts_ip_path_idx'),
             models.Index(fields=['city']),
-            models.Index(fields=['timestamp']),
         ]
     
     def __str__(self):
@@ -32,7 +37,9 @@ class RequestLog(models.Model):
 
 
 class BlockedIP(models.Model):
-    ip_address = models.GenericIPAddressField(unique=True)
+    ip_address = models.GenericIPAddressField(unique=True, blank=True, null=True)
+    cidr = models.CharField(max_length=43, unique=True, blank=True, null=True,
+                            help_text="Network range to block instead of a single IP, e.g. 203.0.113.0/24")
     created_at = models.DateTimeField(auto_now_add=True)
     reason = models.TextField(blank=True, null=True, help_text="Optional reason for blocking this IP")
     
@@ -40,20 +47,34 @@ class BlockedIP(models.Model):
         verbose_name = 'Blocked IP'
         verbose_name_plural = 'Blocked IPs'
         ordering = ['-created_at']
+        constraints = [
+            # Each entry blocks exactly one single address or one network range
+            models.CheckConstraint(
+                check=(
+                    models.Q(ip_address__isnull=False, cidr__isnull=True) |
+                    (models.Q(ip_address__isnull=True, cidr__isnull=False) & ~models.Q(cidr=''))
+                ),
+                name='blockedip_ip_xor_cidr'
+            ),
+        ]
     
     def __str__(self):
-        return f"{self.ip_address} (blocked at {self.created_at})"
+        return f"{self.ip_address or self.cidr} (blocked at {self.created_at})"
     
     def clean(self):
-        """Validate the IP address"""
+        """Validate the IP address or network range"""
+        if bool(self.ip_address) == bool(self.cidr):
+            raise ValidationError("Provide either an IP address or a CIDR range, not both")
+        if self.cidr:
+            try:
+                self.cidr = str(ipaddress.ip_network(self.cidr, strict=False))
+            except ValueError:
+                raise ValidationError(f"Invalid CIDR range: {self.cidr}")
+            return
         try:
             ipaddress.ip_address(self.ip_address)
         except ValueError:
             raise ValidationError(f"Invalid IP address: {self.ip_address}")
-    
-    def save(self, *args, **kwargs):
-        self.clean()
-        super().save(*args, **kwargs)
 
 
 class SuspiciousIP(models.Model):
@@ -68,7 +89,7 @@ class SuspiciousIP(models.Model):
     reason = models.CharField(max_length=50, choices=SuspicionReason.choices)
     description = models.TextField(blank=True, null=True, help_text="Detailed description of suspicious activity")
     first_detected = models.DateTimeField(auto_now_add=True)
-    last_detected = models.DateTimeField(auto_now=True)
+    last_detected = models.DateTimeField(default=timezone.now, help_text="When the activity was last detected")
     request_count = models.IntegerField(default=0, help_text="Number of requests in detection period")
     sensitive_paths = models.JSONField(default=list, blank=True, help_text="List of sensitive paths accessed")
     is_active = models.BooleanField(default=True, help_text="Whether this suspicion is currently active")
@@ -78,7 +99,6 @@ class SuspiciousIP(models.Model):
         verbose_name_plural = 'Suspicious IPs'
         ordering = ['-last_detected']
         indexes = [
-            models.Index(fields=['ip_address']),
             models.Index(fields=['reason']),
             models.Index(fields=['is_active']),
         ]
@@ -92,10 +112,6 @@ class SuspiciousIP(models.Model):
             ipaddress.ip_address(self.ip_address)
         except ValueError:
             raise ValidationError(f"Invalid IP address: {self.ip_address}")
-    
-    def save(self, *args, **kwargs):
-        self.clean()
-        super().save(*args, **kwargs)
 
 
 class AnomalyDetectionConfig(models.Model):
@@ -118,6 +134,11 @@ class AnomalyDetectionConfig(models.Model):
             return cls.objects.get(name=name).value
         except cls.DoesNotExist:
             return default
+    
+    @classmethod
+    def get_configs(cls):
+        """Fetch every configuration value in one query, as a name -> value dict"""
+        return dict(cls.objects.values_list('name', 'value'))
 
 
 # Cache model for geolocation data
@@ -133,6 +154,9 @@ class GeolocationCache(models.Model):
     isp = models.CharField(max_length=100, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    expires_at = models.DateTimeField(db_index=True)
+    
+    TTL = timedelta(hours=24)
     
     class Meta:
         verbose_name = 'Geolocation Cache'
@@ -147,4 +171,11 @@ class GeolocationCache(models.Model):
     
     def is_expired(self):
         """Check if cache entry is older than 24 hours"""
-        return timezone.now() > self.updated_at + timezone.timedelta(hours=24)
+        return timezone.now() > self.expires_at
+    
+    def save(self, *args, **kwargs):
+        self.expires_at = timezone.now() + self.TTL
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'expires_at'}
+        super().save(*args, **kwargs)
@@ -1,3 +1,5 @@
+import os
+
 # django-ip-geolocation settings :cite[1]:cite[6]
 IP_GEOLOCATION_SETTINGS = {
     'BACKEND': 'django_ip_geolocation.backends.IPGeolocationAPI',
@@ -11,22 +13,30 @@ IP_GEOLOCATION_SETTINGS = {
     'USER_CONSENT_VALIDATOR': None
 }
 
-# Cache settings (using Redis recommended for production)
+# Local MaxMind GeoLite2 City database (requires `pip install maxminddb`).
+# When set, IPs are geolocated in-process instead of via external APIs.
+IP_TRACKING_GEOIP_DATABASE = os.environ.get('GEOIP_DATABASE')  # e.g. '/usr/share/GeoIP/GeoLite2-City.mmdb'
+
+# Cache settings: a shared Redis cache, so every worker process sees the same
+# geolocation entries, pending-lookup markers and rate-limit counters
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/1'),
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CONNECTION_POOL_KWARGS': {'max_connections': 100},
+            # redis-py uses the hiredis C parser automatically when the
+            # `hiredis` package is installed (`pip install redis[hiredis]`)
+        }
     }
 }
 
-# Alternatively, for production use Redis:
+# For local development without Redis (per-process, not shared between workers):
 # CACHES = {
-#     "default": {
-#         "BACKEND": "django_redis.cache.RedisCache",
-#         "LOCATION": "redis://127.0.0.1:6379/1",
-#         "OPTIONS": {
-#             "CLIENT_CLASS": "django_redis.client.DefaultClient",
-#         }
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+#         'LOCATION': 'unique-snowflake',
 #     }
 # }
 
@@ -41,26 +51,7 @@ MIDDLEWARE = [
 
 # Rate limiting configuration
 RATELIMIT_ENABLE = True
-RATELIMIT_USE_CACHE = 'default'
-
-# Cache configuration (using Redis recommended for production)
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
-    }
-}
-
-# For production, use Redis cache backend:
-# CACHES = {
-#     "default": {
-#         "BACKEND": "django_redis.cache.RedisCache",
-#         "LOCATION": "redis://127.0.0.1:6379/1",
-#         "OPTIONS": {
-#             "CLIENT_CLASS": "django_redis.client.DefaultClient",
-#         }
-#     }
-# }
+RATELIMIT_USE_CACHE = 'default'  # The shared Redis cache configured above
 
 # Authentication backends (if not already set)
 AUTHENTICATION_BACKENDS = [
@@ -78,3 +69,23 @@ REST_FRAMEWORK = {
         'user': '10/min'  # 10 requests per minute for authenticated users
     }
 }
+
+# Database settings: keep connections open between requests so the
+# middleware's queries don't pay a connect/auth handshake every time
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'alx_backend_security'),
+        'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        'CONN_MAX_AGE': 60,  # seconds; None keeps connections open indefinitely
+        'CONN_HEALTH_CHECKS': True,  # Django 4.1+: drop dead connections before reuse
+    }
+}
+
+# Behind PgBouncer in transaction-pooling mode, connections are pooled by
+# PgBouncer instead; point HOST/PORT at it and disable server-side cursors:
+# DATABASES['default']['CONN_MAX_AGE'] = 0
+# DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
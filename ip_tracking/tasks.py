@@ -1,14 +1,33 @@
 from celery import shared_task
 from celery.schedules import crontab
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.db.models import Count, Q
-from django.db import transaction
+from django.db import transaction, connection
+from django.core.cache import cache
 from .models import RequestLog, SuspiciousIP, AnomalyDetectionConfig, BlockedIP
+from .geolocation import fetch_geolocation_data, store_geolocation_data, geolocation_pending_key
 from datetime import timedelta
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Paths whose access is treated as suspicious
+SENSITIVE_PATHS = frozenset({
+    '/admin/', '/admin/login/', '/api/login/', '/login/',
+    '/api/admin/', '/wp-admin/', '/phpmyadmin/', '/server-status/',
+    '/config/', '/env/', '/.env', '/.git/', '/backup/'
+})
+
+# Login endpoints, where repeated hits are treated as authentication failures
+LOGIN_PATHS = frozenset({'/api/login/', '/login/', '/admin/login/'})
+
+# Most IPs listed in one aggregated warning; full details are in SuspiciousIP
+LOG_SAMPLE_SIZE = 50
+
+# Key of the PostgreSQL advisory lock held by a detection run
+DETECTION_LOCK_ID = 0x1970_5e7e
+
 @shared_task
 def detect_suspicious_ips():
     """
@@ -18,33 +37,40 @@ def detect_suspicious_ips():
     3. Multiple authentication failures
     """
     try:
-        # Get configuration values with defaults
-        high_traffic_threshold = int(AnomalyDetectionConfig.get_config('high_traffic_threshold', '100'))
-        detection_period_minutes = int(AnomalyDetectionConfig.get_config('detection_period_minutes', '60'))
-        
-        # Define sensitive paths
-        sensitive_paths = [
-            '/admin/', '/admin/login/', '/api/login/', '/login/',
-            '/api/admin/', '/wp-admin/', '/phpmyadmin/', '/server-status/',
-            '/config/', '/env/', '/.env', '/.git/', '/backup/'
-        ]
+        # Get configuration values with defaults (one query for the whole run)
+        config = AnomalyDetectionConfig.get_configs()
+        high_traffic_threshold = int(config.get('high_traffic_threshold', '100'))
+        detection_period_minutes = int(config.get('detection_period_minutes', '60'))
         
         # Calculate time threshold
-        time_threshold = timezone.now() - timedelta(minutes=detection_period_minutes)
+        now = timezone.now()
+        time_threshold = now - timedelta(minutes=detection_period_minutes)
         
         logger.info(f"Starting suspicious IP detection for period: {time_threshold}")
         
-        # Detect high traffic IPs
-        detect_high_traffic_ips(time_threshold, high_traffic_threshold)
-        
-        # Detect sensitive path access
-        detect_sensitive_path_access(time_threshold, sensitive_paths)
-        
-        # Detect multiple authentication failures
-        detect_auth_failures(time_threshold)
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # One run at a time, held until commit: row locks can't stop two
+                # overlapping runs from both inserting an IP seen for the first
+                # time, where the later upsert would overwrite the earlier one
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s)', [DETECTION_LOCK_ID])
+            
+            # IPs already flagged are skipped; read after taking the lock so a
+            # run that waited sees the IPs the previous run just flagged
+            active_ips = set(
+                SuspiciousIP.objects.filter(is_active=True).values_list('ip_address', flat=True)
+            )
+            
+            # Detect high traffic, sensitive path access and multiple authentication failures
+            detect_suspicious_activity(time_threshold, high_traffic_threshold, active_ips, now)
         
-        # Clean up old suspicious IP entries
-        cleanup_old_suspicious_ips()
+        # Clean up old suspicious IP entries on another worker, only once this
+        # run's upsert has committed so rows it re-flagged aren't deleted
+        try:
+            cleanup_old_suspicious_ips.delay()
+        except Exception as e:
+            logger.error(f"Could not schedule suspicious IP cleanup: {str(e)}")
         
         logger.info("Suspicious IP detection completed successfully")
         
@@ -52,169 +78,283 @@ def detect_suspicious_ips():
         logger.error(f"Error in detect_suspicious_ips task: {str(e)}")
         raise
 
-def detect_high_traffic_ips(time_threshold, threshold):
-    """Detect IPs with excessive requests"""
-    high_traffic_ips = RequestLog.objects.filter(
+def upsert_suspicious_ips(entries):
+    """
+    Insert new SuspiciousIP rows and update existing ones (matched on
+    ip_address) in a single INSERT ... ON CONFLICT statement per batch
+    """
+    if entries:
+        SuspiciousIP.objects.bulk_create(
+            entries,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['ip_address'],
+            update_fields=['reason', 'description', 'request_count', 'sensitive_paths',
+                           'last_detected', 'is_active']
+        )
+
+def detect_suspicious_activity(time_threshold, high_traffic_threshold, active_ips, now):
+    """
+    Detect high traffic, sensitive path access and repeated login attempts
+    with one aggregation over the detection window instead of one scan each.
+    An IP matching several checks is flagged for the first, in that order.
+    """
+    activity = RequestLog.objects.filter(
         timestamp__gte=time_threshold
     ).values('ip_address').annotate(
-        request_count=Count('id')
+        # Count only columns in reqlog_ts_ip_path_idx, so the aggregate can
+        # use an index-only scan (Count('*') doesn't accept a filter, and path
+        # is never NULL, so counting it is the same as counting rows)
+        request_count=Count('*'),
+        sensitive_count=Count('path', filter=Q(path__in=SENSITIVE_PATHS)),
+        # This would need additional logic to detect actual failures
+        # For now, we'll assume high frequency to login paths indicates failures
+        login_count=Count('path', filter=Q(path__in=LOGIN_PATHS)),
     ).filter(
-        request_count__gte=threshold
-    ).exclude(
-        ip_address__in=SuspiciousIP.objects.filter(is_active=True).values_list('ip_address', flat=True)
+        Q(request_count__gte=high_traffic_threshold) |
+        Q(sensitive_count__gt=0) |
+        Q(login_count__gte=5)  # 5+ login attempts in an hour
     )
     
-    for ip_data in high_traffic_ips:
+    high_traffic = []
+    sensitive_access = []
+    auth_failures = []
+    # Stream the aggregate in chunks rather than materialising every row
+    for ip_data in activity.iterator(chunk_size=2000):
+        if ip_data['ip_address'] in active_ips:
+            continue
+        if ip_data['request_count'] >= high_traffic_threshold:
+            high_traffic.append(ip_data)
+        elif ip_data['sensitive_count'] > 0:
+            sensitive_access.append(ip_data)
+        else:
+            auth_failures.append(ip_data)
+    
+    # Per-path counts, only for the IPs flagged for sensitive access
+    access_by_ip = {}
+    if sensitive_access:
+        for path_data in RequestLog.objects.filter(
+            timestamp__gte=time_threshold,
+            path__in=SENSITIVE_PATHS,
+            ip_address__in=[ip_data['ip_address'] for ip_data in sensitive_access]
+        ).values('ip_address', 'path').annotate(access_count=Count('*')).iterator(chunk_size=2000):
+            paths = access_by_ip.setdefault(path_data['ip_address'], {})
+            paths[path_data['path']] = path_data['access_count']
+    
+    # Paths and counts recorded on earlier detections, so they can be merged.
+    # The rows stay locked until the upsert commits, so no other writer can
+    # change them in between (concurrent detection runs are serialized by
+    # the advisory lock in detect_suspicious_ips).
+    flagged_ips = [ip_data['ip_address'] for ip_data in high_traffic + sensitive_access + auth_failures]
+    existing = {
+        ip_address: (request_count, paths or [])
+        for ip_address, request_count, paths in SuspiciousIP.objects.select_for_update().filter(
+            ip_address__in=flagged_ips
+        ).values_list('ip_address', 'request_count', 'sensitive_paths')
+    } if flagged_ips else {}
+    
+    entries = []
+    for ip_data in high_traffic:
         ip_address = ip_data['ip_address']
-        request_count = ip_data['request_count']
-        
-        with transaction.atomic():
-            suspicious_ip, created = SuspiciousIP.objects.get_or_create(
-                ip_address=ip_address,
-                defaults={
-                    'reason': SuspiciousIP.SuspicionReason.HIGH_TRAFFIC,
-                    'description': f"High traffic detected: {request_count} requests in the last hour",
-                    'request_count': request_count,
-                    'is_active': True
-                }
-            )
-            
-            if not created:
-                suspicious_ip.reason = SuspiciousIP.SuspicionReason.HIGH_TRAFFIC
-                suspicious_ip.description = f"High traffic detected: {request_count} requests in the last hour"
-                suspicious_ip.request_count = request_count
-                suspicious_ip.last_detected = timezone.now()
-                suspicious_ip.is_active = True
-                suspicious_ip.save()
-        
-        logger.warning(f"High traffic detected from IP {ip_address}: {request_count} requests")
-
-def detect_sensitive_path_access(time_threshold, sensitive_paths):
-    """Detect IPs accessing sensitive paths"""
-    sensitive_access_ips = RequestLog.objects.filter(
-        timestamp__gte=time_threshold,
-        path__in=sensitive_paths
-    ).values('ip_address', 'path').annotate(
-        access_count=Count('id')
-    ).exclude(
-        ip_address__in=SuspiciousIP.objects.filter(is_active=True).values_list('ip_address', flat=True)
-    )
+        entries.append(SuspiciousIP(
+            ip_address=ip_address,
+            reason=SuspiciousIP.SuspicionReason.HIGH_TRAFFIC,
+            description=f"High traffic detected: {ip_data['request_count']} requests in the last hour",
+            request_count=ip_data['request_count'],
+            sensitive_paths=existing.get(ip_address, (0, []))[1],
+            last_detected=now,
+            is_active=True
+        ))
     
-    for ip_data in sensitive_access_ips:
+    for ip_data in sensitive_access:
         ip_address = ip_data['ip_address']
-        path = ip_data['path']
-        access_count = ip_data['access_count']
-        
-        with transaction.atomic():
-            suspicious_ip, created = SuspiciousIP.objects.get_or_create(
-                ip_address=ip_address,
-                defaults={
-                    'reason': SuspiciousIP.SuspicionReason.SENSITIVE_ACCESS,
-                    'description': f"Access to sensitive path: {path} ({access_count} times)",
-                    'request_count': access_count,
-                    'sensitive_paths': [path],
-                    'is_active': True
-                }
-            )
-            
-            if not created:
-                # Update existing entry
-                current_paths = set(suspicious_ip.sensitive_paths or [])
-                current_paths.add(path)
-                suspicious_ip.reason = SuspiciousIP.SuspicionReason.SENSITIVE_ACCESS
-                suspicious_ip.description = f"Access to sensitive paths: {', '.join(current_paths)}"
-                suspicious_ip.request_count += access_count
-                suspicious_ip.sensitive_paths = list(current_paths)
-                suspicious_ip.last_detected = timezone.now()
-                suspicious_ip.is_active = True
-                suspicious_ip.save()
-        
-        logger.warning(f"Sensitive path access from IP {ip_address}: {path} ({access_count} times)")
-
-def detect_auth_failures(time_threshold):
-    """Detect IPs with multiple authentication failures"""
-    auth_failure_ips = RequestLog.objects.filter(
-        timestamp__gte=time_threshold,
-        path__in=['/api/login/', '/login/', '/admin/login/'],
-        # This would need additional logic to detect actual failures
-        # For now, we'll assume high frequency to login paths indicates failures
-    ).values('ip_address').annotate(
-        attempt_count=Count('id')
-    ).filter(
-        attempt_count__gte=5  # 5+ login attempts in an hour
-    ).exclude(
-        ip_address__in=SuspiciousIP.objects.filter(is_active=True).values_list('ip_address', flat=True)
-    )
+        paths = access_by_ip.get(ip_address, {})
+        access_count = sum(paths.values())
+        if ip_address in existing or len(paths) > 1:
+            previous_count, previous_paths = existing.get(ip_address, (0, []))
+            all_paths = sorted(set(previous_paths) | set(paths))
+            description = f"Access to sensitive paths: {', '.join(all_paths)}"
+            request_count = previous_count + access_count
+        else:
+            all_paths = list(paths)
+            description = f"Access to sensitive path: {', '.join(all_paths)} ({access_count} times)"
+            request_count = access_count
+        entries.append(SuspiciousIP(
+            ip_address=ip_address,
+            reason=SuspiciousIP.SuspicionReason.SENSITIVE_ACCESS,
+            description=description,
+            request_count=request_count,
+            sensitive_paths=all_paths,
+            last_detected=now,
+            is_active=True
+        ))
     
-    for ip_data in auth_failure_ips:
+    for ip_data in auth_failures:
         ip_address = ip_data['ip_address']
-        attempt_count = ip_data['attempt_count']
-        
-        with transaction.atomic():
-            suspicious_ip, created = SuspiciousIP.objects.get_or_create(
-                ip_address=ip_address,
-                defaults={
-                    'reason': SuspiciousIP.SuspicionReason.MULTIPLE_FAILURES,
-                    'description': f"Multiple authentication attempts: {attempt_count} attempts in the last hour",
-                    'request_count': attempt_count,
-                    'is_active': True
-                }
-            )
-            
-            if not created:
-                suspicious_ip.reason = SuspiciousIP.SuspicionReason.MULTIPLE_FAILURES
-                suspicious_ip.description = f"Multiple authentication attempts: {attempt_count} attempts in the last hour"
-                suspicious_ip.request_count = attempt_count
-                suspicious_ip.last_detected = timezone.now()
-                suspicious_ip.is_active = True
-                suspicious_ip.save()
-        
-        logger.warning(f"Multiple auth attempts from IP {ip_address}: {attempt_count} attempts")
+        entries.append(SuspiciousIP(
+            ip_address=ip_address,
+            reason=SuspiciousIP.SuspicionReason.MULTIPLE_FAILURES,
+            description=f"Multiple authentication attempts: {ip_data['login_count']} attempts in the last hour",
+            request_count=ip_data['login_count'],
+            sensitive_paths=existing.get(ip_address, (0, []))[1],
+            last_detected=now,
+            is_active=True
+        ))
+    
+    upsert_suspicious_ips(entries)
+    
+    # One line per check rather than one per IP
+    if high_traffic:
+        rows = [(ip_data['ip_address'], ip_data['request_count']) for ip_data in high_traffic]
+        logger.warning(f"High traffic detected from {len(rows)} IPs: {rows[:LOG_SAMPLE_SIZE]}")
+    if sensitive_access:
+        rows = [(ip_data['ip_address'], ip_data['sensitive_count']) for ip_data in sensitive_access]
+        logger.warning(f"Sensitive path access from {len(rows)} IPs: {rows[:LOG_SAMPLE_SIZE]}")
+    if auth_failures:
+        rows = [(ip_data['ip_address'], ip_data['login_count']) for ip_data in auth_failures]
+        logger.warning(f"Multiple auth attempts from {len(rows)} IPs: {rows[:LOG_SAMPLE_SIZE]}")
 
+@shared_task
 def cleanup_old_suspicious_ips():
     """Clean up suspicious IP entries older than 7 days"""
     cleanup_threshold = timezone.now() - timedelta(days=7)
-    deleted_count, _ = SuspiciousIP.objects.filter(
+    old_entries = SuspiciousIP.objects.filter(
         last_detected__lt=cleanup_threshold,
         is_active=False
-    ).delete()
+    )
+    # Nothing references these rows, so skip the deletion collector and
+    # issue a single plain DELETE
+    deleted_count = old_entries._raw_delete(old_entries.db)
     
     logger.info(f"Cleaned up {deleted_count} old suspicious IP entries")
 
 @shared_task
-def auto_block_suspicious_ips():
+def cleanup_old_request_logs():
     """
-    Automatically block IPs that have been flagged as suspicious multiple times
+    Delete request logs older than the retention period.
+    Rows are removed oldest first in bounded batches along the timestamp
+    index, so each DELETE stays short instead of one statement locking
+    and rewriting the whole table.
     """
     try:
-        auto_block_threshold = int(AnomalyDetectionConfig.get_config('auto_block_threshold', '3'))
-        block_duration_days = int(AnomalyDetectionConfig.get_config('block_duration_days', '7'))
+        config = AnomalyDetectionConfig.get_configs()
+        retention_days = int(config.get('request_log_retention_days', '30'))
+        batch_size = int(config.get('request_log_cleanup_batch_size', '10000'))
+        cleanup_threshold = timezone.now() - timedelta(days=retention_days)
         
-        # Find IPs with multiple suspicious activities
-        frequent_suspicious_ips = SuspiciousIP.objects.filter(
-            is_active=True
-        ).values('ip_address').annotate(
-            suspicion_count=Count('id')
-        ).filter(
-            suspicion_count__gte=auto_block_threshold
+        total_deleted = 0
+        while True:
+            batch_ids = list(
+                RequestLog.objects.filter(
+                    timestamp__lt=cleanup_threshold
+                ).order_by('timestamp').values_list('id', flat=True)[:batch_size]
+            )
+            if not batch_ids:
+                break
+            batch = RequestLog.objects.filter(id__in=batch_ids)
+            deleted_count = batch._raw_delete(batch.db)
+            total_deleted += deleted_count
+        
+        logger.info(f"Cleaned up {total_deleted} request logs older than {retention_days} days")
+        
+    except Exception as e:
+        logger.error(f"Error in cleanup_old_request_logs task: {str(e)}")
+        raise
+
+def create_auto_blocks(auto_block_threshold):
+    """Block frequently flagged IPs through the ORM; returns the IPs blocked"""
+    # Find IPs with multiple suspicious activities
+    frequent_suspicious_ips = list(SuspiciousIP.objects.filter(
+        is_active=True
+    ).values('ip_address').annotate(
+        suspicion_count=Count('id')
+    ).filter(
+        suspicion_count__gte=auto_block_threshold
+    ))
+    if not frequent_suspicious_ips:
+        return []
+    
+    # Skip IPs that are already blocked (one query for all candidates)
+    already_blocked = set(BlockedIP.objects.filter(
+        ip_address__in=[ip_data['ip_address'] for ip_data in frequent_suspicious_ips]
+    ).values_list('ip_address', flat=True))
+    
+    new_blocks = [
+        BlockedIP(
+            ip_address=ip_data['ip_address'],
+            reason=f"Automatically blocked due to {ip_data['suspicion_count']} suspicious activities"
         )
+        for ip_data in frequent_suspicious_ips
+        if ip_data['ip_address'] not in already_blocked
+    ]
+    BlockedIP.objects.bulk_create(new_blocks, ignore_conflicts=True, batch_size=1000)
+    return [blocked_ip.ip_address for blocked_ip in new_blocks]
+
+def insert_auto_blocks(auto_block_threshold):
+    """
+    Block frequently flagged IPs with a single INSERT ... SELECT on PostgreSQL,
+    skipping IPs that are already blocked; returns the IPs blocked
+    """
+    blocked_table = connection.ops.quote_name(BlockedIP._meta.db_table)
+    suspicious_table = connection.ops.quote_name(SuspiciousIP._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {blocked_table} (ip_address, reason, created_at)
+            SELECT ip_address,
+                   'Automatically blocked due to ' || COUNT(*) || ' suspicious activities',
+                   %s
+            FROM {suspicious_table}
+            WHERE is_active
+            GROUP BY ip_address
+            HAVING COUNT(*) >= %s
+            ON CONFLICT (ip_address) DO NOTHING
+            RETURNING ip_address
+        """, [timezone.now(), auto_block_threshold])
+        return [str(row[0]) for row in cursor.fetchall()]
+
+@shared_task
+def auto_block_suspicious_ips():
+    """
+    Automatically block IPs that have been flagged as suspicious multiple times
+    """
+    try:
+        config = AnomalyDetectionConfig.get_configs()
+        auto_block_threshold = int(config.get('auto_block_threshold', '3'))
+        block_duration_days = int(config.get('block_duration_days', '7'))
         
-        blocked_count = 0
+        if connection.vendor == 'postgresql':
+            # Decide and insert in the database in one statement
+            blocked_ips = insert_auto_blocks(auto_block_threshold)
+        else:
+            blocked_ips = create_auto_blocks(auto_block_threshold)
+        blocked_count = len(blocked_ips)
         
-        for ip_data in frequent_suspicious_ips:
-            ip_address = ip_data['ip_address']
-            
-            # Check if already blocked
-            if not BlockedIP.objects.filter(ip_address=ip_address).exists():
-                BlockedIP.objects.create(
-                    ip_address=ip_address,
-                    reason=f"Automatically blocked due to {ip_data['suspicion_count']} suspicious activities"
-                )
-                blocked_count += 1
-                logger.warning(f"Automatically blocked suspicious IP: {ip_address}")
+        if blocked_ips:
+            logger.warning(f"Automatically blocked {blocked_count} suspicious IPs: {list(blocked_ips)[:LOG_SAMPLE_SIZE]}")
         
         logger.info(f"Auto-blocked {blocked_count} suspicious IPs")
         
     except Exception as e:
         logger.error(f"Error in auto_block_suspicious_ips task: {str(e)}")
         raise
+
+@shared_task(ignore_result=True)
+def fetch_and_update_geolocation(ip_address, scheduled_at):
+    """
+    Resolve geolocation for an IP address outside the request cycle,
+    cache it and backfill the request logs recorded since the lookup
+    was scheduled (an ISO 8601 timestamp)
+    """
+    try:
+        geolocation_data = fetch_geolocation_data(ip_address)
+        store_geolocation_data(ip_address, geolocation_data)
+        
+        if geolocation_data['country']:
+            updated = RequestLog.objects.filter(
+                ip_address=ip_address,
+                timestamp__gte=parse_datetime(scheduled_at),
+                country__isnull=True
+            ).update(**geolocation_data)
+            logger.info(f"Backfilled geolocation for {updated} request logs from IP {ip_address}")
+    finally:
+        cache.delete(geolocation_pending_key(ip_address))
@@ -9,7 +9,13 @@ from ratelimit.core import get_usage
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
 from .models import RequestLog
-import json
+from .middleware import request_log_writer, parse_client_ip
+import orjson
+
+# JSON response helper backed by orjson
+def orjson_response(data, status=200):
+    """JSON response serialized with orjson instead of Django's JSON encoder"""
+    return HttpResponse(orjson.dumps(data), status=status, content_type='application/json')
 
 # Function-based view with rate limiting
 @ratelimit(key='ip', rate='5/m', method=['POST'], block=True)
@@ -23,7 +29,7 @@ def login_view(request):
     """
     if request.method == 'POST':
         try:
-            data = json.loads(request.body)
+            data = orjson.loads(request.body)
             username = data.get('username')
             password = data.get('password')
             
@@ -31,22 +37,22 @@ def login_view(request):
             
             if user is not None:
                 login(request, user)
-                # Log successful login
-                RequestLog.objects.create(
+                # Log successful login (written with the next batch)
+                request_log_writer.put(RequestLog(
                     ip_address=get_client_ip(request),
                     path=request.path,
-                    country='N/A',
+                    country=None,  # Column holds 2-letter codes only
                     city='N/A',
                     isp='N/A'
-                )
-                return JsonResponse({'status': 'success', 'message': 'Login successful'})
+                ))
+                return orjson_response({'status': 'success', 'message': 'Login successful'})
             else:
-                return JsonResponse({'status': 'error', 'message': 'Invalid credentials'}, status=401)
+                return orjson_response({'status': 'error', 'message': 'Invalid credentials'}, status=401)
                 
-        except json.JSONDecodeError:
-            return JsonResponse({'status': 'error', 'message': 'Invalid JSON'}, status=400)
+        except orjson.JSONDecodeError:
+            return orjson_response({'status': 'error', 'message': 'Invalid JSON'}, status=400)
     
-    return JsonResponse({'status': 'error', 'message': 'Method not allowed'}, status=405)
+    return orjson_response({'status': 'error', 'message': 'Method not allowed'}, status=405)
 
 @login_required
 def logout_view(request):
@@ -56,16 +62,19 @@ def logout_view(request):
     logout(request)
     return JsonResponse({'status': 'success', 'message': 'Logout successful'})
 
+# Pre-serialized api_status body; only the timestamp changes per request
+_API_STATUS_PREFIX = b'{"status": "ok", "timestamp": "'
+_API_STATUS_SUFFIX = b'", "message": "API is running"}'
+
 @ratelimit(key='ip', rate='10/m', block=True)
 def api_status(request):
     """
     Public API status endpoint with rate limiting
     """
-    return JsonResponse({
-        'status': 'ok',
-        'timestamp': timezone.now().isoformat(),
-        'message': 'API is running'
-    })
+    return HttpResponse(
+        _API_STATUS_PREFIX + timezone.now().isoformat().encode() + _API_STATUS_SUFFIX,
+        content_type='application/json'
+    )
 
 @ratelimit(key='user', rate='20/m', block=True)
 @login_required
@@ -109,14 +118,13 @@ class SensitiveDataView(View):
 # Utility function to get client IP
 def get_client_ip(request):
     """
-    Get the client's IP address from the request object
+    Get the client's IP address from the request object.
+    Uses the value IPLoggingMiddleware already parsed when it is installed.
     """
-    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-    if x_forwarded_for:
-        ip = x_forwarded_for.split(',')[0].strip()
-    else:
-        ip = request.META.get('REMOTE_ADDR')
-    return ip
+    client_ip = getattr(request, 'client_ip', None)
+    if client_ip:
+        return client_ip
+    return parse_client_ip(request)
 
 # Rate limit status endpoint
 @ratelimit(key='ip', rate='1/m', block=True)